@@ -286,7 +286,7 @@ class Controller:
                             image_attr['location'] = pics[0].location
                         else:
                             field_name = self.__model.EXIF_TO_FIELD[key]
-                            image_attr[key] = pics[0].__dict__[field_name]  # TODO nicer using namedtuple for Pic
+                            image_attr[key] = getattr(pics[0], field_name)
                     if self.__mqtt_config['use_mqtt']:
                         self.publish_state(pics[0].fname, image_attr)
             self.__model.pause_looping = self.__viewer.is_in_transition()
@@ -16,14 +16,24 @@ class GetImageMeta:
     def __init__(self, filename):
         self.__logger = logging.getLogger("get_image_meta.GetImageMeta")
         self.__tags = {}
-        self.__filename = filename  # in case no exif data in which case needed for size
-        image = self.get_image_object(filename)
-        if image:
+        self.__filename = filename
+        self.__size = (0, 0)
+        try:
+            # only the header is read here, so the size and meta data come from this one lazy open
+            # without decoding (or converting) the pixels
+            image = Image.open(filename)
+        except Exception as e:
+            self.__logger.warning("Can't open file: \"%s\"", filename)
+            self.__logger.warning("Cause: %s", e)
+            return
+        with image:
+            self.__size = image.size
             exif = image.getexif()
             self.__do_image_tags(exif)
             self.__do_exif_tags(exif)
             self.__do_geo_tags(exif)
-            self.__do_iptc_keywords()
+            if image.format != 'HEIF':  # no IPTC block in HEIF, iptcinfo3 would scan the whole file for one
+                self.__do_iptc_keywords()
             try:
                 xmp = image.getxmp()
                 if len(xmp) > 0:
@@ -220,11 +230,7 @@ class GetImageMeta:
             return None
 
     def get_size(self):
-        try:  # corrupt image file might crash app
-            return GetImageMeta.get_image_object(self.__filename).size
-        except Exception as e:
-            self.__logger.warning("get_size failed on %s -> %s", self.__filename, e)
-            return (0, 0)
+        return self.__size  # (0, 0) if the file couldn't be opened
 
     @staticmethod
     def get_image_object(fname):
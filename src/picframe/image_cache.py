@@ -3,12 +3,36 @@ import os
 import time
 import logging
 import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from picframe import get_image_meta
 
+try:
+    from watchdog.observers import Observer  # optional, lets the cache skip walking unchanged folder trees
+except ImportError:
+    Observer = None
+
+EXIF_BATCH_SIZE = 8  # new files whose meta data is read in parallel before inserting them
+FULL_SCAN_INTERVALS = 10  # with a watcher, still walk the tree every this many update intervals (NFS etc)
+GEO_RETRY_DELAY = 600.0  # seconds before a failed reverse lookup of the same lat/lon is tried again
+
+
+class FolderWatcher:
+    """watchdog event handler that only records that something under the picture folder changed"""
+
+    CHANGE_EVENTS = ('created', 'deleted', 'modified', 'moved')  # not opened/closed, the viewer reads files
+
+    def __init__(self):
+        self.changed = True  # always scan once at start
+
+    def dispatch(self, event):
+        if event.event_type in FolderWatcher.CHANGE_EVENTS:
+            self.changed = True
+
 
 class ImageCache:
 
-    EXTENSIONS = ['.png', '.jpg', '.jpeg', '.heif', '.heic']
+    EXTENSIONS = frozenset(('.png', '.jpg', '.jpeg', '.heif', '.heic'))
     EXIF_TO_FIELD = {'EXIF FNumber': 'f_number',
                      'Image Make': 'make',
                      'Image Model': 'model',
@@ -34,10 +58,12 @@ class ImageCache:
         self.__follow_links = follow_links
         self.__db_file = db_file
         self.__geo_reverse = geo_reverse
+        self.__geo_failed = {}  # (lat, lon) -> time of last failed lookup, found ones are in the location table
         self.__update_interval = update_interval
         self.__portrait_pairs = portrait_pairs  # TODO have a function to turn this on and off?
         self.__db = self.__create_open_db(self.__db_file)
         self.__db_write_lock = threading.Lock()  # lock to serialize db writes between threads
+        self.__exif_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="image_cache")
         # NB this is where the required schema is set
         self.__update_schema(3)
 
@@ -46,21 +72,45 @@ class ImageCache:
         self.__shutdown_completed = False
         self.__purge_files = False
 
+        self.__watcher = None
+        self.__observer = None
+        self.__last_full_scan = 0.0
+
         t = threading.Thread(target=self.__loop)
         t.start()
 
     def __loop(self):
+        self.__start_watching()
         while self.__keep_looping:
             if not self.__pause_looping:
                 self.update_cache()
                 time.sleep(self.__update_interval)
             time.sleep(0.01)
+        if self.__observer is not None:
+            self.__observer.stop()
+            self.__observer.join()
+        self.__exif_pool.shutdown()
         self.__db_write_lock.acquire()
         self.__db.commit()  # close after update_cache finished for last time
         self.__db_write_lock.release()
         self.__db.close()
         self.__shutdown_completed = True
 
+    def __start_watching(self):
+        # Run on the cache thread, a recursive watch adds an inotify watch for every folder in the tree
+        if Observer is None:
+            return
+        try:
+            watcher = FolderWatcher()
+            observer = Observer()
+            observer.schedule(watcher, self.__picture_dir, recursive=True)
+            observer.start()
+        except Exception as e:  # i.e. inotify watch limit reached or picture_dir missing
+            self.__logger.warning("Can't watch %s for changes, polling instead: %s", self.__picture_dir, e)
+            return
+        self.__watcher = watcher
+        self.__observer = observer
+
     def pause_looping(self, value):
         self.__pause_looping = value
 
@@ -79,17 +129,23 @@ class ImageCache:
         self.__logger.debug('Updating cache')
 
         # If the current collection of updated files is empty, check for disk-based changes
-        if not self.__modified_files:
+        disk_folders = None
+        if not self.__modified_files and self.__disk_may_have_changed():
             self.__logger.debug('No unprocessed files in memory, checking disk')
-            self.__modified_folders = self.__get_modified_folders()
+            disk_folders = self.__get_folders()
+            self.__modified_folders = self.__get_modified_folders(disk_folders)
             self.__modified_files = self.__get_modified_files(self.__modified_folders)
             self.__logger.debug('Found %d new files on disk', len(self.__modified_files))
 
         # While we have files to process and looping isn't paused
         while self.__modified_files and not self.__pause_looping:
-            file = self.__modified_files.pop(0)
-            self.__logger.debug('Inserting: %s', file)
-            self.__insert_file(file)
+            batch = self.__modified_files[:EXIF_BATCH_SIZE]
+            del self.__modified_files[:EXIF_BATCH_SIZE]
+            # reading the meta data is mostly waiting on the disk, so do a batch of files at once
+            metas = self.__exif_pool.map(self.__get_exif_info, [file for file, _mod_tm in batch])
+            for (file, mod_tm), meta in zip(batch, metas):
+                self.__logger.debug('Inserting: %s', file)
+                self.__insert_file(file, mod_tm=mod_tm, meta=meta)
 
         # If we've process all files in the current collection, update the cached folder info
         if not self.__modified_files:
@@ -97,14 +153,27 @@ class ImageCache:
             self.__modified_folders.clear()
 
         # If looping is still not paused, remove any files or folders from the db that are no longer on disk
-        if not self.__pause_looping:
-            self.__purge_missing_files_and_folders()
+        if not self.__pause_looping and (disk_folders is not None or self.__purge_files):
+            self.__purge_missing_files_and_folders(disk_folders)
 
         # Commit the current set of changes
         self.__db_write_lock.acquire()
         self.__db.commit()
         self.__db_write_lock.release()
 
+    def __disk_may_have_changed(self):
+        """Without a watcher the folder tree is walked on every update, with one only when it
+        reported a change or, as a fallback for file systems without notification, now and then.
+        """
+        if self.__watcher is None:
+            return True
+        now = time.monotonic()
+        if self.__watcher.changed or now - self.__last_full_scan > self.__update_interval * FULL_SCAN_INTERVALS:
+            self.__watcher.changed = False  # reset before the walk so changes during it trigger another
+            self.__last_full_scan = now
+            return True
+        return False
+
     def query_cache(self, where_clause, sort_clause='fname ASC'):
         cursor = self.__db.cursor()
         cursor.row_factory = None  # we don't want the "sqlite3.Row" setting from the db here...
@@ -128,16 +197,20 @@ class ImageCache:
                 pair_list = cursor.execute(sql).fetchall()
                 newlist = []
                 skip_portrait_slot = False
-                for i in range(len(full_list)):
-                    if full_list[i][0] != -1:
-                        newlist.append(full_list[i])
+                num_pairs = len(pair_list)
+                p = 0  # next unused portrait, pop(0) would make the pairing quadratic
+                for row in full_list:
+                    if row[0] != -1:
+                        newlist.append(row)
                     elif skip_portrait_slot:
                         skip_portrait_slot = False
                         continue
-                    elif pair_list:
-                        elem = pair_list.pop(0)
-                        if pair_list:
-                            elem += pair_list.pop(0)
+                    elif p < num_pairs:
+                        elem = pair_list[p]
+                        p += 1
+                        if p < num_pairs:
+                            elem += pair_list[p]
+                            p += 1
                             # Here, we just doubled-up a set of portrait images.
                             # Skip the next available "portrait slot" as it's unneeded.
                             skip_portrait_slot = True
@@ -149,18 +222,20 @@ class ImageCache:
     def get_file_info(self, file_id):
         if not file_id:
             return None
-        sql = "SELECT * FROM all_data where file_id = {0}".format(file_id)
-        row = self.__db.execute(sql).fetchone()
+        sql = "SELECT * FROM all_data where file_id = ?"  # parameter, so sqlite3 reuses the prepared statement
+        row = self.__db.execute(sql, (file_id,)).fetchone()
         try:
             if row is not None and row['last_modified'] != os.path.getmtime(row['fname']):
                 self.__logger.debug('Cache miss: File %s changed on disk', row['fname'])
                 self.__insert_file(row['fname'], file_id)
-                row = self.__db.execute(sql).fetchone()  # description inserted in table
+                row = self.__db.execute(sql, (file_id,)).fetchone()  # description inserted in table
         except OSError:
             self.__logger.warning("Image '%s' does not exists or is inaccessible", row['fname'])
-        if row is not None and row['latitude'] is not None and row['longitude'] is not None and row['location'] is None:
+            return None  # callers skip missing files, no need to count it as displayed
+        if (self.__geo_reverse is not None and row is not None and row['latitude'] is not None
+                and row['longitude'] is not None and row['location'] is None):
             if self.__get_geo_location(row['latitude'], row['longitude']):
-                row = self.__db.execute(sql).fetchone()  # description inserted in table
+                row = self.__db.execute(sql, (file_id,)).fetchone()  # description inserted in table
         sql = "UPDATE file SET displayed_count = displayed_count + 1, last_displayed = ? WHERE file_id = ?"
         starttime = round(time.time() * 1000)
         self.__db_write_lock.acquire()
@@ -179,10 +254,19 @@ class ImageCache:
         return [row['name'] for row in rows]
 
     def __get_geo_location(self, lat, lon):  # TODO periodically check all lat/lon in meta with no location and try again # noqa: E501
+        failed_tm = self.__geo_failed.get((lat, lon))
+        if failed_tm is not None and time.time() - failed_tm < GEO_RETRY_DELAY:
+            return False  # don't wait for another timeout every time a picture from here is shown
         location = self.__geo_reverse.get_address(lat, lon)
         if len(location) == 0:
+            now = time.time()
+            # forget failures that would be retried anyway so the dict doesn't grow for ever
+            self.__geo_failed = {key: failed_tm for key, failed_tm in self.__geo_failed.items()
+                                 if now - failed_tm < GEO_RETRY_DELAY}
+            self.__geo_failed[(lat, lon)] = now
             return False  # TODO this will continue to try even if there is some permanant cause
         else:
+            self.__geo_failed.pop((lat, lon), None)
             sql = "INSERT OR REPLACE INTO location (latitude, longitude, description) VALUES (?, ?, ?)"
             starttime = round(time.time() * 1000)
             self.__db_write_lock.acquire()
@@ -293,6 +377,10 @@ class ImageCache:
 
         db = sqlite3.connect(db_file, check_same_thread=False)
         db.row_factory = sqlite3.Row  # make results accessible by field name
+        # The db is a cache of what is on disk, so trade the fsyncs of every commit (slow on SD cards)
+        # for write ahead logging. A power cut can lose the last commits but can't corrupt the file.
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
         for item in (sql_folder_table, sql_file_table, sql_meta_table, sql_location_table, sql_meta_index,
                      sql_all_data_view, sql_db_info_table, sql_clean_file_trigger, sql_clean_meta_trigger):
             db.execute(item)
@@ -353,55 +441,89 @@ class ImageCache:
     #     - Found on disk, but newer than the associated record in the 'folder' table
     #     - Found on disk, but flagged as 'missing' in the 'folder' table
     # --- Note that all folders returned currently exist on disk
-    def __get_modified_folders(self):
+    def __get_modified_folders(self, disk_folders):
         out_of_date_folders = []
         sql_select = "SELECT * FROM folder WHERE name = ?"
-        for dir in [d[0] for d in os.walk(self.__picture_dir, followlinks=self.__follow_links)]:
-            if os.path.basename(dir):
-                if os.path.basename(dir)[0] == '.':
-                    continue  # ignore hidden folders
-            mod_tm = int(os.stat(dir).st_mtime)
+        for dir, mod_tm in disk_folders:
             found = self.__db.execute(sql_select, (dir,)).fetchone()
             if not found or found['last_modified'] < mod_tm or found['missing'] == 1:
                 out_of_date_folders.append((dir, mod_tm))
         return out_of_date_folders
 
+    def __get_folders(self):
+        """Walk the picture folder tree with os.scandir, returning (folder, mtime) tuples.
+        The mtime of each sub folder comes from its DirEntry. Hidden folders are left out but,
+        as with os.walk, the folders below them are still returned.
+        """
+        try:
+            walk = [(self.__picture_dir, int(os.stat(self.__picture_dir).st_mtime),
+                     os.path.basename(self.__picture_dir).startswith('.'))]
+        except OSError:
+            return []  # picture folder missing, same as os.walk returning nothing
+        folders = []
+        i = 0
+        while i < len(walk):
+            dir, mod_tm, hidden = walk[i]
+            if not hidden:
+                folders.append((dir, mod_tm))
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        # nothing below .AppleDouble is ever used so don't descend into it at all
+                        if entry.name != '.AppleDouble' and entry.is_dir(follow_symlinks=self.__follow_links):
+                            walk.append((entry.path, int(entry.stat().st_mtime), entry.name.startswith('.')))
+            except OSError as e:
+                self.__logger.warning("Can't scan folder %s: %s", dir, e)
+            i += 1
+        return folders
+
     def __get_modified_files(self, modified_folders):
         out_of_date_files = []
-        # sql_select = "SELECT fname, last_modified FROM all_data WHERE fname = ? and last_modified >= ?"
+        # one query per folder for the cached mtimes, rather than one per file on disk
         sql_select = """
-        SELECT file.basename, file.last_modified
+        SELECT file.basename, file.extension, file.last_modified
             FROM file
                 INNER JOIN folder
                     ON folder.folder_id = file.folder_id
-            WHERE file.basename = ? AND file.extension = ? AND folder.name = ? AND file.last_modified >= ?
+            WHERE folder.name = ?
         """
-        for dir, _date in modified_folders:
-            for file in os.listdir(dir):
-                base, extension = os.path.splitext(file)
-                if (extension.lower() in ImageCache.EXTENSIONS
-                        # have to filter out all the Apple junk
-                        and '.AppleDouble' not in dir and not file.startswith('.')):
-                    full_file = os.path.join(dir, file)
-                    mod_tm = os.path.getmtime(full_file)
-                    found = self.__db.execute(sql_select, (base, extension.lstrip("."), dir, mod_tm)).fetchone()
-                    if not found:
-                        out_of_date_files.append(full_file)
+        unreadable = []
+        for dir, _date in modified_folders:  # hidden folders and .AppleDouble are already left out
+            cached = {(row['basename'], row['extension']): row['last_modified']
+                      for row in self.__db.execute(sql_select, (dir,))}
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        if entry.name.startswith('.'):
+                            continue
+                        base, dot, extension = entry.name.rpartition('.')  # cheaper than splitext, same split
+                        if dot and ('.' + extension.lower()) in ImageCache.EXTENSIONS:
+                            last_modified = cached.get((base, extension))
+                            mod_tm = entry.stat().st_mtime
+                            if last_modified is None or last_modified < mod_tm:
+                                out_of_date_files.append((entry.path, mod_tm))  # keep mtime, saves a stat on insert
+            except OSError as e:
+                self.__logger.warning("Can't scan folder %s: %s", dir, e)
+                unreadable.append(dir)
+        if unreadable:  # don't record these as up to date, so they are tried again on the next walk
+            modified_folders[:] = [folder for folder in modified_folders if folder[0] not in unreadable]
         return out_of_date_files
 
-    def __insert_file(self, file, file_id=None):
+    def __insert_file(self, file, file_id=None, mod_tm=None, meta=None):
         file_insert = "INSERT OR REPLACE INTO file(folder_id, basename, extension, last_modified) VALUES((SELECT folder_id from folder where name = ?), ?, ?, ?)"  # noqa: E501
         file_update = "UPDATE file SET folder_id = (SELECT folder_id from folder where name = ?), basename = ?, extension = ?, last_modified = ? WHERE file_id = ?"  # noqa: E501
         # Insert the new folder if it's not already in the table. Update the missing field separately.
         folder_insert = "INSERT OR IGNORE INTO folder(name) VALUES(?)"
         folder_update = "UPDATE folder SET missing = 0 where name = ?"
 
-        mod_tm = os.path.getmtime(file)
+        if mod_tm is None:
+            mod_tm = os.path.getmtime(file)
         dir, file_only = os.path.split(file)
         base, extension = os.path.splitext(file_only)
 
         # Get the file's meta info and build the INSERT statement dynamically
-        meta = self.__get_exif_info(file)
+        if meta is None:
+            meta = self.__get_exif_info(file)
         meta_insert = self.__get_meta_sql_from_dict(meta)
         vals = list(meta.values())
         vals.insert(0, file)
@@ -434,11 +556,14 @@ class ImageCache:
         ques = ', '.join('?' * len(dict.keys()))
         return 'INSERT OR REPLACE INTO meta(file_id, {0}) VALUES((SELECT file_id from all_data where fname = ?), {1})'.format(columns, ques)  # noqa: E501
 
-    def __purge_missing_files_and_folders(self):
-        # Find folders in the db that are no longer on disk
+    def __purge_missing_files_and_folders(self, disk_folders=None):
+        # Find folders in the db that are no longer on disk. If the tree has just been walked only the
+        # folders it didn't return need checking. The walk carries on past folders it can't read (SMB
+        # hiccups, permissions), so not being walked alone doesn't mean a folder has gone.
+        on_disk = frozenset() if disk_folders is None else {name for name, _mod_tm in disk_folders}
         folder_id_list = []
         for row in self.__db.execute('SELECT folder_id, name from folder'):
-            if not os.path.exists(row['name']):
+            if row['name'] not in on_disk and not os.path.exists(row['name']):
                 folder_id_list.append([row['folder_id']])
 
         # Flag or delete any non-existent folders from the db. Note, deleting will automatically
@@ -496,7 +621,7 @@ class ImageCache:
             # not valid here anyway (should be in SubSecTimeOriginal), but it does exist sometimes.
             val = val.split('.', 1)[0]
             try:
-                e['exif_datetime'] = time.mktime(time.strptime(val, '%Y:%m:%d %H:%M:%S'))
+                e['exif_datetime'] = self.__exif_datetime_to_timestamp(val)
             except Exception:
                 pass
 
@@ -517,6 +642,18 @@ class ImageCache:
 
         return e
 
+    def __exif_datetime_to_timestamp(self, val):
+        # Slicing the usual 'YYYY:MM:DD HH:MM:SS' straight into a datetime is much cheaper than strptime.
+        # Anything else (single digit fields, leap seconds etc.) still goes through strptime.
+        if len(val) == 19 and val[4] == val[7] == val[13] == val[16] == ':' and val[10] == ' ':
+            digits = (val[0:4], val[5:7], val[8:10], val[11:13], val[14:16], val[17:19])
+            if all(d.isascii() and d.isdigit() for d in digits):
+                try:
+                    return time.mktime(datetime(*map(int, digits)).timetuple())
+                except ValueError:
+                    pass
+        return time.mktime(time.strptime(val, '%Y:%m:%d %H:%M:%S'))
+
 
 # If being executed (instead of imported), kick it off...
 if __name__ == "__main__":
@@ -32,6 +32,9 @@ class InterfacePeripherals:
         self.__model = model
         self.__viewer = viewer
         self.controller = controller
+        self.__mouse = None
+        self.__keyboard = None
+        self.__check_input = None
 
         self.__input_type = self.__model.get_peripherals_config()["input_type"]
         if not self.__input_type:
@@ -47,60 +50,50 @@ class InterfacePeripherals:
             return
 
         self.__menu_autohide_tm = self.__model.get_viewer_config()["menu_autohide_tm"]
+        self.__menu_autohide_ns = int(self.__menu_autohide_tm * 1_000_000_000) if self.__menu_autohide_tm else 0
         self.__buttons = self.__model.get_peripherals_config()["buttons"]
+        # Workaround, pi3d seems to always assume screen ratio 4:3 so touch is incorrectly translated
+        # to x, y on screens with a different ratio
+        self.__touch_y_scale = 4 * self.__viewer.display_height / (3 * self.__viewer.display_width)
 
         self.__gui = self.__get_gui()
         self.__mouse = self.__get_mouse()
         self.__keyboard = self.__get_keyboard()
 
-        self.__menu_buttons = self.__get_menu_buttons()
+        menu_items = self.__get_menu_items()
         self.__menu_height = (
-            min(self.__viewer.display_width, self.__viewer.display_height) // 4 if self.__menu_buttons else 0
+            min(self.__viewer.display_width, self.__viewer.display_height) // 4 if menu_items else 0
         )
+        self.__menu_bg = self.__get_menu_bg()  # before the buttons, the gui draws widgets in creation order
+        self.__menu_buttons = self.__get_menu_buttons(menu_items)
         self.__menu = self.__get_menu()
         self.__menu_bg_widget = self.__get_menu_bg_widget()
         self.__back_area, self.__next_area = self.__get_navigation_areas()
-        self.__menu_bg = self.__get_menu_bg()
+        self.__shortcuts = frozenset(widget.shortcut for widget in self.__gui.widgets if widget.shortcut)
         self.__menu_is_on = False
         self.__mouse_is_down = False
         self.__last_touch_position = None
         self.__last_menu_show_at = 0
         self.__clock_is_suspended = False
-        self.__pointer_position = (0, 0)
-        self.__timestamp = 0
+        self.__timestamp = None
+
+        # input_type is fixed for the lifetime of this instance, so pick the per-frame handler once
+        self.__check_input = {
+            "keyboard": self.__handle_keyboard_input,
+            "touch": self.__check_touch_input,
+            "mouse": self.__check_mouse_input,
+        }[self.__input_type]
 
     def check_input(self) -> None:
         """Checks for any input from the selected peripheral device and handles it."""
-        if not self.__input_type:
-            return
-
-        if self.__input_type == "keyboard":
-            self.__handle_keyboard_input()
-
-        elif self.__input_type in ["touch", "mouse"]:
-            self.__timestamp = time.time()
-            self.__update_pointer_position()
-
-            if self.__input_type == "touch":
-                self.__handle_touch_input()
-
-            elif self.__input_type == "mouse":
-                self.__handle_mouse_input()
-
-            # Autohide menu
-            if self.menu_is_on:
-                if self.__menu_autohide_tm and self.__timestamp - self.__last_menu_show_at > self.__menu_autohide_tm:
-                    self.menu_is_on = False
-                else:
-                    self.__menu_bg.draw()
-
-            self.__gui.draw(*self.__pointer_position)
+        if self.__check_input:
+            self.__check_input()
 
     def stop(self) -> None:
         """Gracefully stops any active peripheral device."""
-        if hasattr(self, "__mouse") and self.__mouse:
+        if self.__mouse:
             self.__mouse.stop()
-        if hasattr(self, "__keyboard") and self.__keyboard:
+        if self.__keyboard:
             self.__keyboard.close()
 
     @property
@@ -111,16 +104,24 @@ class InterfacePeripherals:
     def menu_is_on(self, val: bool) -> None:
         self.__menu_is_on = val
         if val:
-            self.__last_menu_show_at = self.__timestamp
+            self.__last_menu_show_at = self.__now()
             if self.__viewer.clock_is_on:
                 self.__clock_is_suspended = True
                 self.__viewer.clock_is_on = False
             self.__menu.show()
+            self.__menu_bg.visible = True
         else:
             if self.__clock_is_suspended:
                 self.__clock_is_suspended = False
                 self.__viewer.clock_is_on = True
             self.__menu.hide()
+            self.__menu_bg.visible = False
+
+    def __now(self) -> int:
+        """Monotonic timestamp of the current frame, read at most once per `check_input`."""
+        if self.__timestamp is None:
+            self.__timestamp = time.monotonic_ns()
+        return self.__timestamp
 
     def __get_gui(self) -> "pi3d.Gui":
         font = pi3d.Font(
@@ -146,16 +147,19 @@ class InterfacePeripherals:
         if self.__input_type == "keyboard":
             return pi3d.Keyboard()
 
-    def __get_menu_buttons(self) -> typing.List["IPMenuItem"]:
-        btns = []
+    def __get_menu_items(self) -> typing.List[typing.Tuple[type, dict]]:
+        """Menu item classes of the enabled buttons, with their config."""
+        items = []
         for name, props in self.__buttons.items():
             if not props["enable"]:
                 continue
             for _, cls in inspect.getmembers(sys.modules[__name__], inspect.isclass):
                 if issubclass(cls, IPMenuItem) and cls is not IPMenuItem and cls.config_name == name:
-                    btn = cls(self, self.__gui, props["label"], shortcut=props["shortcut"])
-                    btns.append(btn)
-        return btns
+                    items.append((cls, props))
+        return items
+
+    def __get_menu_buttons(self, menu_items: typing.List[typing.Tuple[type, dict]]) -> typing.List["IPMenuItem"]:
+        return [cls(self, self.__gui, props["label"], shortcut=props["shortcut"]) for cls, props in menu_items]
 
     def __get_menu(self) -> "pi3d.Menu":
         x = -self.__viewer.display_width // 2
@@ -168,6 +172,28 @@ class InterfacePeripherals:
             menu.hide()
         return menu
 
+    def __get_menu_bg(self) -> "MenuBackground":
+        """Gradient behind the menu buttons, drawn in the gui pass and only visible with the menu."""
+        array = np.zeros((self.__menu_height, 1, 4), dtype=np.uint8)
+        array[:, :, 3] = np.linspace(120, 0, self.__menu_height).reshape(-1, 1)
+        texture = pi3d.Texture(array, blend=True, mipmap=False, free_after_load=True)
+        sprite = pi3d.ImageSprite(
+            texture,
+            self.__gui.shader,
+            w=self.__viewer.display_width,
+            h=self.__menu_height,
+            x=0,
+            y=0,
+        )
+        widget = MenuBackground(
+            self.__gui,
+            sprite,
+            x=-self.__viewer.display_width // 2,
+            y=self.__viewer.display_height // 2,
+        )
+        widget.visible = False
+        return widget
+
     def __get_menu_bg_widget(self) -> "pi3d.util.Gui.Widget":
         """This widget lies between navigation areas and menu buttons.
         It intercepts clicks into the empty menu area which would otherwise trigger navigation.
@@ -181,7 +207,6 @@ class InterfacePeripherals:
             h=self.__menu_height,
             x=0,
             y=0,
-            z=4.0,
         )
         return pi3d.util.Gui.Widget(
             self.__gui,
@@ -232,85 +257,89 @@ class InterfacePeripherals:
         )
         return back_area, next_area
 
-    def __get_menu_bg(self) -> "pi3d.ImageSprite":
-        array = np.zeros((self.__menu_height, 1, 4), dtype=np.uint8)
-        array[:, :, 3] = np.linspace(120, 0, self.__menu_height).reshape(-1, 1)
-        texture = pi3d.Texture(array, blend=True, mipmap=False, free_after_load=True)
-        return pi3d.ImageSprite(
-            texture,
-            self.__gui.shader,
-            w=self.__viewer.display_width,
-            h=self.__menu_height,
-            x=0,
-            y=int(self.__viewer.display_height // 2 - self.__menu_height // 2),
-            z=4.0,
-        )
+    def __check_touch_input(self) -> None:
+        self.__timestamp = None  # read lazily, only if this frame needs it
+        position = self.__get_touch_position()
+        self.__handle_touch_input(position)
+        self.__update_menu(position)
+
+    def __check_mouse_input(self) -> None:
+        self.__timestamp = None  # read lazily, only if this frame needs it
+        position = self.__get_mouse_position()
+        self.__handle_mouse_input(position)
+        self.__update_menu(position)
+
+    def __update_menu(self, position: typing.Tuple[float, float]) -> None:
+        # Autohide menu
+        if self.menu_is_on and self.__menu_autohide_ns:
+            if self.__now() - self.__last_menu_show_at > self.__menu_autohide_ns:
+                self.menu_is_on = False
+
+        self.__gui.draw(*position)
 
     def __handle_keyboard_input(self) -> None:
         code = self.__keyboard.read_code()
         if len(code) > 0:
             if not self.controller.display_is_on:
                 self.controller.display_is_on = True
-            else:
+            elif code in self.__shortcuts:  # skip the widget scan for keys nothing listens to
                 self.__gui.checkkey(code)
 
-    def __handle_touch_input(self) -> None:
+    def __handle_touch_input(self, position: typing.Tuple[float, float]) -> None:
         """Due to pi3d not reliably detecting touch as Mouse.LEFT_BUTTON event
         when a touch happens at any position with x or y lower than previous touch,
         any pointer movement is considered a click event.
         """
-        if self.__pointer_moved():
+        if self.__pointer_moved(position):
             if not self.controller.display_is_on:
                 self.controller.display_is_on = True
-            elif self.__pointer_position[1] < self.__viewer.display_height // 2 - self.__menu_height:
+            elif position[1] < self.__viewer.display_height // 2 - self.__menu_height:
                 # Touch in main area
                 if self.menu_is_on:
                     self.menu_is_on = False
                 else:
-                    self.__handle_click()
+                    self.__handle_click(position)
             else:
                 # Touch in menu area
                 if self.menu_is_on:
-                    self.__handle_click()
+                    self.__handle_click(position)
                 self.menu_is_on = True  # Reset clock for autohide
 
-    def __handle_mouse_input(self) -> None:
-        if self.__pointer_moved() and not self.controller.display_is_on:
+    def __handle_mouse_input(self, position: typing.Tuple[float, float]) -> None:
+        if self.__pointer_moved(position) and not self.controller.display_is_on:
             self.controller.display_is_on = True
 
         # Show or hide menu
-        self.menu_is_on = self.__pointer_position[1] > self.__viewer.display_height // 2 - self.__menu_height
+        self.menu_is_on = position[1] > self.__viewer.display_height // 2 - self.__menu_height
 
         # Detect click
         if self.__mouse.button_status() == self.__mouse.LEFT_BUTTON and not self.__mouse_is_down:
             self.__mouse_is_down = True
-            self.__handle_click()
+            self.__handle_click(position)
         elif self.__mouse.button_status() != self.__mouse.LEFT_BUTTON and self.__mouse_is_down:
             self.__mouse_is_down = False
 
-    def __update_pointer_position(self) -> None:
+    def __get_mouse_position(self) -> typing.Tuple[float, float]:
+        position_x, position_y = self.__mouse.position()
+        return (position_x - self.__viewer.display_width // 2, position_y - self.__viewer.display_height // 2)
+
+    def __get_touch_position(self) -> typing.Tuple[float, float]:
         position_x, position_y = self.__mouse.position()
-        if self.__input_type == "mouse":
-            position_x -= self.__viewer.display_width // 2
-            position_y -= self.__viewer.display_height // 2
-        elif self.__input_type == "touch":
-            # Workaround, pi3d seems to always assume screen ratio 4:3 so touch is incorrectly translated
-            # to x, y on screens with a different ratio
-            position_y *= self.__viewer.display_height / (self.__viewer.display_width * 3 / 4)
-        self.__pointer_position = (position_x, position_y)
-
-    def __pointer_moved(self) -> bool:
+        position_y *= self.__touch_y_scale
+        return (position_x, position_y)
+
+    def __pointer_moved(self, position: typing.Tuple[float, float]) -> bool:
         if not self.__last_touch_position:
-            self.__last_touch_position = self.__pointer_position
+            self.__last_touch_position = position
 
-        if self.__last_touch_position != self.__pointer_position:
-            self.__last_touch_position = self.__pointer_position
+        if self.__last_touch_position != position:
+            self.__last_touch_position = position
             return True
         return False
 
-    def __handle_click(self) -> None:
-        logger.debug("handling click at position x: %s, y: %s", *self.__pointer_position)
-        self.__gui.check(*self.__pointer_position)
+    def __handle_click(self, position: typing.Tuple[float, float]) -> None:
+        logger.debug("handling click at position x: %s, y: %s", *position)
+        self.__gui.check(*position)
 
     def __go_back(self, position) -> None:
         logger.info("navigation: previous picture")
@@ -321,6 +350,15 @@ class InterfacePeripherals:
         self.controller.next()
 
 
+class MenuBackground(pi3d.util.Gui.Widget):
+    """Widget that only draws. It comes before the menu buttons in the gui so that it is drawn
+    under them, and must not take their clicks as the gui stops at the first widget hit.
+    """
+
+    def check(self, x, y) -> bool:
+        return False
+
+
 class IPMenuItem(pi3d.MenuItem):
     """Wrapper around pi3d.MenuItem that implements `action` method.
     In the future, this class can be extended to support toggling of multiple text labels
@@ -3,6 +3,35 @@ from ninepatch import Ninepatch
 import numpy as np
 import random
 import logging
+import threading
+import functools
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import cv2  # optional, only used to speed up KmeansNp
+except ImportError:
+    cv2 = None
+
+COLORIZED_MAT_CACHE_SIZE = 2  # full display sized RGB images, an outer and an inner mat
+
+rng = np.random.default_rng()
+
+DROP_SHADOW_ALPHA_LUT = [(a * a + 127) // 255 for a in range(256)]
+
+NINEPATCH_CACHE_SIZE = 4  # picture sized RGBA renders, about as many as one style uses
+
+MatResources = namedtuple('MatResources', ['mat_texture', 'bevel', 'drop_shadow', 'inner_shadow', 'highlight'])
+
+
+@functools.lru_cache(maxsize=None)
+def load_resources(resource_folder):
+    """Open the mat texture and nine-patches once per folder, they are only ever read."""
+    return MatResources(Image.open('{0}/mat_texture.jpg'.format(resource_folder)).convert("L"),
+                        Ninepatch('{0}/9_patch_bevel.png'.format(resource_folder)),
+                        Ninepatch('{0}/9_patch_drop_shadow.png'.format(resource_folder)),
+                        Ninepatch('{0}/9_patch_inner_shadow.png'.format(resource_folder)),
+                        Ninepatch('{0}/9_patch_highlight.png'.format(resource_folder)))
 
 
 class MatImage:
@@ -22,6 +51,8 @@ class MatImage:
                             'double_flat']
 
         self.__logger = logging.getLogger("mat_image.MatImage")
+        self.__ninepatch_cache = {}
+        self.__ninepatch_lock = threading.Lock()
 
         self.auto_inner_mat_color = auto_inner_mat_color
         self.display_size = display_size
@@ -34,11 +65,12 @@ class MatImage:
         self.inner_mat_use_texture = inner_mat_use_texture
 
         # --- Matting resources ---
-        self.__mat_texture = Image.open('{0}/mat_texture.jpg'.format(resource_folder)).convert("L")
-        self.__9patch_bevel = Ninepatch('{0}/9_patch_bevel.png'.format(resource_folder))
-        self.__9patch_drop_shadow = Ninepatch('{0}/9_patch_drop_shadow.png'.format(resource_folder))
-        self.__9patch_inner_shadow = Ninepatch('{0}/9_patch_inner_shadow.png'.format(resource_folder))
-        self.__9patch_highlight = Ninepatch('{0}/9_patch_highlight.png'.format(resource_folder))
+        (self.__mat_texture, self.__9patch_bevel, self.__9patch_drop_shadow,
+         self.__9patch_inner_shadow, self.__9patch_highlight) = load_resources(resource_folder)
+        self.__sized_mat_texture = None
+        self.__colorized_mat_cache = {}
+        self.__colorized_mat_lock = threading.Lock()  # mats of a portrait pair are built in parallel
+        self.__pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mat_image")
 
     # endregion Constructor
 
@@ -158,122 +190,104 @@ class MatImage:
     # region Matting Styles
 
     def __style_float(self, images):
-        pic_count = len(images)
-        pic_wid = (self.display_width / pic_count) - (((pic_count + 1) / pic_count) * self.outer_mat_border)
-        pic_height = self.display_height - (self.outer_mat_border * 2)
+        pic_wid, pic_height = self.__get_pic_size(len(images))
 
-        final_images = []
-        for image in images:
+        def mat_one(image):
             image = self.__scale_image(image, (pic_wid, pic_height))
             self.__add_image_outline(image, self.__outer_mat_color_save, auto_adjust=True)
             image = self.__add_drop_shadow(image)
-            final_images.append(image)
+            return image
 
-        return self.__layout_images(final_images)
+        return self.__layout_images(self.__map_images(mat_one, images))
 
     def __style_float_polaroid(self, images):
         border_width = 18
-        pic_count = len(images)
-        pic_wid = ((self.display_width / pic_count)
-                   - (((pic_count + 1) / pic_count) * self.outer_mat_border)
-                   - (border_width * 2))
-        pic_height = self.display_height - (self.outer_mat_border * 2) - (border_width * 2)
+        pic_wid, pic_height = self.__get_pic_size(len(images), border_width)
 
-        final_images = []
-        for image in images:
+        def mat_one(image):
             image = self.__scale_image(image, (pic_wid, pic_height))
             self.__add_image_outline(image, self.__outer_mat_color_save)
-            image = ImageOps.expand(image, border_width)
-            self.__add_image_outline(image, (210, 210, 210), outline_width=border_width)
-            image = self.__add_drop_shadow(image)
-            final_images.append(image)
+            return self.__add_drop_shadow(image, border_width, (210, 210, 210))
 
-        return self.__layout_images(final_images)
+        return self.__layout_images(self.__map_images(mat_one, images))
 
     def __style_float_color_wrap(self, images):
         border_width = 18
-        pic_count = len(images)
-        pic_wid = ((self.display_width / pic_count)
-                   - (((pic_count + 1) / pic_count) * self.outer_mat_border)
-                   - (border_width * 2))
-        pic_height = self.display_height - (self.outer_mat_border * 2) - (border_width * 2)
+        pic_wid, pic_height = self.__get_pic_size(len(images), border_width)
 
-        final_images = []
-        for image in images:
+        def mat_one(image):
             color = self.__get_darker_shade(self.__outer_mat_color_save, 0.35)
             color2 = self.__get_darker_shade(self.__outer_mat_color_save, 0.2)
             image = self.__scale_image(image, (pic_wid, pic_height))
             self.__add_image_outline(image, color2)
-            image = ImageOps.expand(image, border_width)
-            self.__add_image_outline(image, color, outline_width=border_width)
-            highlight = self.__9patch_highlight.render(image.width, image.height,  Image.Resampling.LANCZOS)
-            image.paste(highlight, (0, 0), highlight)
-            image = self.__add_drop_shadow(image)
-            final_images.append(image)
+            highlight = self.__render_ninepatch(self.__9patch_highlight, image.width + (border_width * 2),
+                                                image.height + (border_width * 2))
+            image = self.__add_drop_shadow(image, border_width, color)
+            # RGB source so only the colour is blended, the frame and picture must stay fully opaque
+            image.paste(highlight.convert('RGB'), (0, 0), highlight)
+            return image
 
-        return self.__layout_images(final_images)
+        return self.__layout_images(self.__map_images(mat_one, images))
 
     def __style_single_mat_bevel(self, images):
         bevel_wid = 5
-        pic_count = len(images)
-        pic_wid = ((self.display_width / pic_count)
-                   - (((pic_count + 1) / pic_count) * self.outer_mat_border)
-                   - (bevel_wid * 2))
-        pic_height = self.display_height - (self.outer_mat_border * 2) - (bevel_wid * 2)
+        pic_wid, pic_height = self.__get_pic_size(len(images), bevel_wid)
 
-        final_images = []
-        for image in images:
+        def mat_one(image):
             image = self.__scale_image(image, (pic_wid, pic_height))
             image = self.__add_outer_bevel(image)
-            final_images.append(image)
+            return image
 
-        return self.__layout_images(final_images)
+        return self.__layout_images(self.__map_images(mat_one, images))
 
     def __style_double_mat_bevel(self, images):
         bevel_wid = 5
-        pic_count = len(images)
-        pic_wid = ((self.display_width / pic_count)
-                   - (((pic_count + 1) / pic_count) * self.outer_mat_border)
-                   - (self.inner_mat_border * 2)
-                   - (bevel_wid * 4))
-        pic_height = self.display_height - (self.outer_mat_border * 2) - (self.inner_mat_border * 2) - (bevel_wid * 4)
-
-        final_images = []
-        for image in images:
+        inset = self.inner_mat_border + bevel_wid  # picture position inside its bevelled inner mat
+        pic_wid, pic_height = self.__get_pic_size(len(images), inset + bevel_wid)
+
+        def mat_one(image):
             image = self.__scale_image(image, (pic_wid, pic_height))
-            mat_size = (image.width + (self.inner_mat_border * 2) + (bevel_wid * 2),
-                        image.height + (self.inner_mat_border * 2) + (bevel_wid * 2))
-            mat_image = self.__get_inner_mat(mat_size)
+            mat_size = (image.width + inset * 2, image.height + inset * 2)
+            mat_image = self.__get_inner_mat(mat_size, shared=len(images) > 1)
             mat_image = self.__add_outer_bevel(mat_image)
             image = self.__add_outer_bevel(image)
-            mat_image.paste(image, (self.inner_mat_border + bevel_wid, self.inner_mat_border + bevel_wid))
-            final_images.append(mat_image)
+            mat_image.paste(image, (inset, inset))
+            return mat_image
 
-        return self.__layout_images(final_images)
+        return self.__layout_images(self.__map_images(mat_one, images))
 
     def __style_double_mat_flat(self, images):
-        pic_count = len(images)
-        pic_wid = ((self.display_width / pic_count)
-                   - (((pic_count + 1) / pic_count) * self.outer_mat_border)
-                   - (self.inner_mat_border * 2))
-        pic_height = self.display_height - (self.outer_mat_border * 2) - (self.inner_mat_border * 2)
+        inset = self.inner_mat_border
+        pic_wid, pic_height = self.__get_pic_size(len(images), inset)
 
-        final_images = []
-        for image in images:
+        def mat_one(image):
             image = self.__scale_image(image, (pic_wid, pic_height))
             self.__add_image_outline(image, self.__outer_mat_color_save)
-            mat_size = (image.width + (self.inner_mat_border * 2), image.height + (self.inner_mat_border * 2))
-            mat_image = self.__get_inner_mat(mat_size)
+            mat_size = (image.width + inset * 2, image.height + inset * 2)
+            mat_image = self.__get_inner_mat(mat_size, shared=len(images) > 1)
             mat_image = self.__add_inner_shadow(mat_image)
-            mat_image.paste(image, (self.inner_mat_border, self.inner_mat_border))
-            final_images.append(mat_image)
+            mat_image.paste(image, (inset, inset))
+            return mat_image
 
-        return self.__layout_images(final_images)
+        return self.__layout_images(self.__map_images(mat_one, images))
 
     # endregion Matting styles
 
     # region Helper Methods
 
+    def __get_pic_size(self, pic_count, frame_wid=0):
+        # Room for each of pic_count pictures side by side on the outer mat, less a frame of frame_wid
+        # around each. Computed once per mat_image call and captured by each style's mat_one.
+        outer_border = self.outer_mat_border
+        return ((self.display_width / pic_count) - (((pic_count + 1) / pic_count) * outer_border) - (frame_wid * 2),
+                self.display_height - (outer_border * 2) - (frame_wid * 2))
+
+    def __map_images(self, func, images):
+        # Pillow releases the GIL while resizing and pasting, so a portrait pair is matted in parallel
+        if len(images) == 1:
+            return [func(images[0])]
+        return list(self.__pool.map(func, images))
+
     def __get_mat_type_from_user_string(self, mat_type_string):
         if mat_type_string is None:
             mat_type_string = ''
@@ -299,7 +313,10 @@ class MatImage:
             width, height = size
 
         scale = min(width/image.width, height/image.height)
-        image = image.resize((int(image.width * scale), int(image.height * scale)), resample=Image.BICUBIC)
+        # reducing_gap lets Pillow box-reduce large photos by an integer factor before
+        # the filtered resize, which is much cheaper for the usual big downscale
+        image = image.resize((int(image.width * scale), int(image.height * scale)),
+                             resample=Image.Resampling.BILINEAR, reducing_gap=2.0)
         return image
 
     def __get_outer_mat_color(self, image):
@@ -310,26 +327,48 @@ class MatImage:
     def __get_darker_shade(self, rgb_color, fractional_percent=0.5):
         return tuple(map(lambda c: int(c * fractional_percent), rgb_color))
 
-    def __get_colorized_mat(self, color, use_texture):
-        if use_texture:
-            mat_img = self.__mat_texture.copy()
-            mat_img = mat_img.resize(self.display_size, resample=Image.BICUBIC)
-            mat_img = ImageOps.colorize(mat_img, black="black", white=color)
-        else:
-            mat_img = Image.new('RGB', self.display_size, color)
-
-        return mat_img
-
-    def __get_inner_mat(self, size):
+    def __get_colorized_mat(self, color, use_texture, keep=False):
+        if not use_texture:
+            return Image.new('RGB', self.display_size, color)
+        if not keep:
+            return self.__colorize_mat_texture(color)
+
+        # Colorizing the full display sized texture is expensive, so callers ask to keep the result
+        # when the colour comes round again: a fixed mat colour or the inner mat of a portrait pair.
+        # An automatic colour is new for nearly every picture, so caching it would only hold memory.
+        # Callers paste onto the mat, so always hand out a copy.
+        key = (tuple(color), self.display_size)
+        with self.__colorized_mat_lock:
+            mat_img = self.__colorized_mat_cache.get(key)
+            if mat_img is None:
+                mat_img = self.__colorize_mat_texture(color)
+                if len(self.__colorized_mat_cache) >= COLORIZED_MAT_CACHE_SIZE:
+                    del self.__colorized_mat_cache[next(iter(self.__colorized_mat_cache))]  # drop the oldest
+                self.__colorized_mat_cache[key] = mat_img
+        return mat_img.copy()
+
+    def __colorize_mat_texture(self, color):
+        sized_mat_texture = self.__sized_mat_texture
+        if sized_mat_texture is None or sized_mat_texture.size != self.display_size:
+            # held as RGB so each colorize is a single lookup table pass over the pixels
+            sized_mat_texture = self.__mat_texture.resize(self.display_size,
+                                                          resample=Image.Resampling.NEAREST).convert("RGB")
+            self.__sized_mat_texture = sized_mat_texture
+        # same black to color ramp as ImageOps.colorize(texture, black="black", white=color)
+        return sized_mat_texture.point([i * c // 255 for c in color for i in range(256)])
+
+    def __get_inner_mat(self, size, shared=False):
         w, h = size
 
         # If the color wasn't specified, get one
         if not self.inner_mat_color:
             color = self.__get_darker_shade(self.__outer_mat_color_save, 0.50)
+            keep = shared or bool(self.outer_mat_color)  # a fixed outer colour gives a fixed inner one
         else:
             color = tuple(self.inner_mat_color)
+            keep = True
 
-        mat = self.__get_colorized_mat(color, self.inner_mat_use_texture)
+        mat = self.__get_colorized_mat(color, self.inner_mat_use_texture, keep)
         mat = mat.crop((0, 0, w, h))
 
         return mat
@@ -337,12 +376,12 @@ class MatImage:
     def __add_outer_bevel(self, image, expand=True):
         if expand:
             image = ImageOps.expand(image, 5)
-        outer_bevel_image = self.__9patch_bevel.render(image.width, image.height, Image.Resampling.LANCZOS)
+        outer_bevel_image = self.__render_ninepatch(self.__9patch_bevel, image.width, image.height)
         image.paste(outer_bevel_image, (0, 0), outer_bevel_image)
         return image
 
     def __add_inner_shadow(self, image):
-        inner_shadow_image = self.__9patch_inner_shadow.render(image.width, image.height,  Image.Resampling.LANCZOS)
+        inner_shadow_image = self.__render_ninepatch(self.__9patch_inner_shadow, image.width, image.height)
         image.paste(inner_shadow_image, (0, 0), inner_shadow_image)
         return image
 
@@ -359,16 +398,40 @@ class MatImage:
         shape = [0, 0, img.width-1, img.height-1]
         rect.rectangle(shape, outline=outline_color, width=outline_width)
 
-    def __add_drop_shadow(self, image):
+    def __add_drop_shadow(self, image, border_width=0, border_color=None):
         shadow_offset = 15
-        mod_image = Image.new('RGBA', (image.width + shadow_offset, image.height + shadow_offset), (0, 0, 0, 0))
-        shadow_image = self.__9patch_drop_shadow.render(mod_image.width, mod_image.height,  Image.Resampling.LANCZOS)
-        mod_image.paste(shadow_image, (0, 0), shadow_image)
-        mod_image.paste(image, (0, 0))
+        width = image.width + border_width * 2
+        height = image.height + border_width * 2
+        # build on the rendered shadow directly, its alpha squared as pasting it onto a transparent canvas did
+        mod_image = self.__render_ninepatch(self.__9patch_drop_shadow, width + shadow_offset,
+                                            height + shadow_offset, DROP_SHADOW_ALPHA_LUT).copy()
+        if border_width > 0:
+            # a solid frame filled straight into the shadow image, rather than expanding the picture first
+            mod_image.paste(border_color, (0, 0, width, height))
+        mod_image.paste(image, (border_width, border_width))
         return mod_image
 
+    def __render_ninepatch(self, ninepatch, width, height, alpha_lut=None):
+        # Pictures from the same camera scale to the same few sizes, so keep the last renders.
+        # The returned image is shared, copy it before drawing onto it.
+        key = (ninepatch.filename, width, height)
+        with self.__ninepatch_lock:
+            rendered = self.__ninepatch_cache.pop(key, None)
+            if rendered is not None:
+                self.__ninepatch_cache[key] = rendered  # reinsert as most recently used
+                return rendered
+        rendered = ninepatch.render(width, height, Image.Resampling.LANCZOS)  # unlocked, so a pair renders in parallel
+        if alpha_lut is not None:
+            rendered.putalpha(rendered.getchannel('A').point(alpha_lut))
+        with self.__ninepatch_lock:
+            if len(self.__ninepatch_cache) >= NINEPATCH_CACHE_SIZE:
+                del self.__ninepatch_cache[next(iter(self.__ninepatch_cache))]  # drop the least recently used
+            self.__ninepatch_cache[key] = rendered
+        return rendered
+
     def __layout_images(self, images):
-        mat_image = self.__get_colorized_mat(self.__outer_mat_color_save, self.outer_mat_use_texture)
+        mat_image = self.__get_colorized_mat(self.__outer_mat_color_save, self.outer_mat_use_texture,
+                                             bool(self.outer_mat_color))
         total_wid = self.outer_mat_border * (len(images) + 1)
         for image in images:
             total_wid += image.width
@@ -394,39 +457,61 @@ class KmeansNp:
         self.size = (size, size)
 
     def run(self, image, start_clusters=None):
-        image = image.copy()
-        image.thumbnail(self.size)
-        im = np.array(image, dtype=float)[:, :, :3]
+        (max_w, max_h) = self.size
+        if image.width > max_w or image.height > max_h:
+            # resize hands back a new small image, so there is no need to copy the full sized
+            # photo first just so that thumbnail() can shrink it in place
+            scale = min(max_w / image.width, max_h / image.height)
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, resample=Image.Resampling.BICUBIC, reducing_gap=2.0)
+        # every other pixel on every other row is an even spread over the image at a quarter of the work
+        im = np.asarray(image, dtype=np.float32)[::2, ::2, :3]
         d = im.shape[-1]  # 3 or 5 if u,v added
         im = im.reshape(-1, d)  # NB need to use floats to avoid coercing to uint8 scrambling subtractions
         n = len(im)
+        if cv2 is not None and start_clusters is None and n >= self.k:
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, self.max_iterations, self.min_distance)
+            _, _, centroids = cv2.kmeans(im, self.k, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+            return self.__sort_by_saturation(centroids)
         if start_clusters is None:
-            centroids = im[np.random.choice(np.arange(n), self.k)]
+            centroids = self.__random_centroids(im)
         else:
-            centroids = np.array(start_clusters, dtype=float)
+            centroids = np.array(start_clusters, dtype=np.float32)
         old_centroids = centroids.copy()
         for i in range(self.max_iterations):
-            im.shape = (1, n, d)  # add dimension to allow broadcasting
-            centroids.shape = (self.k, 1, d)  # ditto
-            dists = (((im - centroids) ** 2).sum(axis=2)) ** 0.5  # euclidean distance - manhattan might be fine and faster # noqa: E501
+            k = len(centroids)  # can drop below self.k if a centroid loses all its pixels
+            # |p - c|^2 = |p|^2 - 2p.c + |c|^2 and |p|^2 is the same for every centroid, so the nearest
+            # centroid only needs |c|^2 - 2p.c, a single (k, n) matmul with no (k, n, d) temporary or sqrt
+            dists = (centroids * centroids).sum(axis=1)[:, None] - 2.0 * (centroids @ im.T)
             ix = np.argmin(dists, axis=0)  # indices of nearest centroid for each pixel
-            im.shape = (n, d)  # reduce dimensions for mean
-            centroids.shape = (self.k, d)  # ditto
-            to_keep = []  # discard any centroids with no pixels nearest to them
-            for j in range(self.k):  # write back average location of all nearest pixels
-                j_pixels = im[ix == j]  # view into im where ix points to centroid j
-                if len(j_pixels) > 0:  # error if try to get mean zero length array TODO remove groups with few pixels?
-                    centroids[j] = j_pixels.mean(axis=0)
-                    to_keep.append(j)
-            if len(to_keep) < len(centroids):  # this will be relatively rare
-                for j in to_keep[::-1]:  # delete in reverse order of index
-                    centroids = np.delete(centroids, j, axis=0)
-                    old_centroids = np.delete(old_centroids, j, axis=0)
-            movement = ((((centroids - old_centroids) ** 2).sum(axis=1)) ** 0.5).max()
-            if movement < self.min_distance:
+            sums = np.zeros((k, d), dtype=np.float32)  # average location of all nearest pixels, in one pass
+            np.add.at(sums, ix, im)
+            counts = np.bincount(ix, minlength=k)
+            to_keep = counts > 0  # discard any centroids with no pixels nearest to them
+            centroids = (sums[to_keep] / counts[to_keep, None]).astype(np.float32)
+            old_centroids = old_centroids[to_keep]
+            movement = ((centroids - old_centroids) ** 2).sum(axis=1).max()  # squared, as is the test below
+            if movement < self.min_distance ** 2:
                 break
             old_centroids = centroids.copy()
 
+        return self.__sort_by_saturation(centroids)
+
+    def __random_centroids(self, im):
+        # Draw pixels without replacement, and skip any the same colour as one already drawn. Picking
+        # indices alone often starts two centroids on one colour in a flat image, merging them at once
+        available = np.ones(len(im), dtype=bool)
+        chosen = []
+        for _ in range(self.k):
+            candidates = np.flatnonzero(available)
+            if len(candidates) == 0:
+                break  # fewer colours than k
+            pixel = im[rng.choice(candidates)]
+            chosen.append(pixel)
+            available &= (im != pixel).any(axis=1)
+        return np.array(chosen, dtype=np.float32)
+
+    def __sort_by_saturation(self, centroids):
         c_max, c_min = centroids[:, :3].max(axis=1), centroids[:, :3].min(axis=1)  # max, min for each centroid
         c_sat = c_max - c_min  # value used previously includes element of lum TODO bias more to lighter using (1.5 * c_max - c_min) # noqa: E501
         ix_order = np.argsort(c_sat)[::-1]  # indices to sorted values - reversed
@@ -3,8 +3,15 @@ import os
 import time
 import logging
 import locale
+import copy
+import shutil
 from picframe import geo_reverse, image_cache
 
+try:
+    from yaml import CSafeLoader as YamlLoader  # libyaml based, much faster than the pure python one
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 DEFAULT_CONFIGFILE = "~/picframe_data/config/configuration.yaml"
 DEFAULT_CONFIG = {
     'viewer': {
@@ -116,7 +123,11 @@ DEFAULT_CONFIG = {
 }
 
 
-class Pic:  # TODO could this be done more elegantly with namedtuple
+class Pic:
+
+    __slots__ = ('fname', 'last_modified', 'file_id', 'orientation', 'exif_datetime', 'f_number', 'exposure_time',
+                 'iso', 'focal_length', 'make', 'model', 'lens', 'rating', 'latitude', 'longitude', 'width',
+                 'height', 'is_portrait', 'location', 'tags', 'caption', 'title')
 
     def __init__(self, fname, last_modified, file_id, orientation=1, exif_datetime=0,
                  f_number=0, exposure_time=None, iso=0, focal_length=None,
@@ -152,15 +163,18 @@ class Model:
     def __init__(self, configfile=DEFAULT_CONFIGFILE):
         self.__logger = logging.getLogger("model.Model")
         self.__logger.debug('creating an instance of Model')
-        self.__config = DEFAULT_CONFIG
-        self.__last_file_change = 0.0
+        self.__config = copy.deepcopy(DEFAULT_CONFIG)  # setters write to this, keep the defaults intact
         configfile = os.path.expanduser(configfile)
         self.__logger.info("Open config file: %s:", configfile)
         with open(configfile, 'r') as stream:
             try:
-                conf = yaml.safe_load(stream)
+                if YamlLoader is yaml.SafeLoader:
+                    self.__logger.warning("PyYAML built without libyaml, config parsing will be slow")
+                conf = yaml.load(stream, Loader=YamlLoader) or {}  # empty file loads as None
                 for section in ['viewer', 'model', 'mqtt', 'http', 'peripherals']:
-                    self.__config[section] = {**DEFAULT_CONFIG[section], **conf[section]}
+                    # the defaults are already a private copy, so update in place. A section left
+                    # out of the yaml (or left empty) just keeps its defaults
+                    self.__config[section].update(conf.get(section) or {})
 
                 self.__logger.debug('config data = %s', self.__config)
             except yaml.YAMLError as exc:
@@ -179,7 +193,9 @@ class Model:
 
         self.__file_list = []  # this is now a list of tuples i.e (file_id1,) or (file_id1, file_id2)
         self.__number_of_files = 0  # this is shortcut for len(__file_list)
+        self.__number_of_images = 0  # total file_ids in __file_list, kept up to date rather than summed per call
         self.__reload_files = True
+        self.__first_load = True  # image_cache may still be filling on the very first query
         self.__file_index = 0  # pointer to next position in __file_list
         self.__current_pics = (None, None)  # this hold a tuple of (pic, None) or two pic objects if portrait pairs
         self.__num_run_through = 0
@@ -197,10 +213,11 @@ class Model:
         self.__image_cache = image_cache.ImageCache(self.__pic_dir,
                                                     model_config['follow_links'],
                                                     os.path.expanduser(model_config['db_file']),
-                                                    self.__geo_reverse,
+                                                    self.__geo_reverse if self.__load_geoloc else None,
                                                     model_config['update_interval'],
                                                     model_config['portrait_pairs'])
-        self.__deleted_pictures = model_config['deleted_pictures']
+        self.__deleted_pictures = os.path.expanduser(model_config['deleted_pictures'])
+        self.__subdir_list = (None, [])  # (pic_dir mtime, sub folder names) as listed by get_directory_list
         self.__no_files_img = os.path.expanduser(model_config['no_files_img'])
         self.__sort_cols = model_config['sort_cols']
         self.__col_names = None
@@ -357,12 +374,16 @@ class Model:
         actual_dir = root
         if self.subdirectory != '':
             actual_dir = self.subdirectory
-        follow_links = self.get_model_config()['follow_links']
-        subdir_list = next(os.walk(self.__pic_dir, followlinks=follow_links))[1]
-        subdir_list[:] = [d for d in subdir_list if not d[0] == '.']
-        if not follow_links:
-            subdir_list[:] = [d for d in subdir_list if not os.path.islink(self.__pic_dir + '/' + d)]
-        subdir_list.insert(0, root)
+        # this is asked for with every mqtt state update, only list pic_dir again when its entries changed
+        mod_tm = os.stat(self.__pic_dir).st_mtime
+        if mod_tm != self.__subdir_list[0]:
+            follow_links = self.get_model_config()['follow_links']
+            with os.scandir(self.__pic_dir) as entries:  # DirEntry already knows if it is a dir or a link
+                subdir_list = [entry.name for entry in entries
+                               if not entry.name.startswith('.')
+                               and entry.is_dir() and (follow_links or not entry.is_symlink())]
+            self.__subdir_list = (mod_tm, subdir_list)
+        subdir_list = [root] + self.__subdir_list[1]  # new list each call, callers sort it
         return actual_dir, subdir_list
 
     def force_reload(self):
@@ -381,12 +402,16 @@ class Model:
 
             # Reload the playlist if requested
             if self.__reload_files:
-                for _i in range(5):  # give image_cache chance on first load if a large directory
+                # give image_cache chance on first load if a large directory. Later on an empty result
+                # (i.e. filters that match nothing) is final, don't stall the slideshow for it each time
+                tries = 5 if self.__first_load else 1
+                for i in range(tries):
                     self.__get_files()
                     missing_images = 0
-                    if self.__number_of_files > 0:
+                    if self.__number_of_files > 0 or i == tries - 1:
                         break
                     time.sleep(0.5)
+                self.__first_load = False
 
             # If we don't have any files to show, prepare the "no images" image
             # Also, set the reload_files flag so we'll check for new files on the next pass...
@@ -413,13 +438,8 @@ class Model:
                 pic_row = self.__image_cache.get_file_info(file_ids[1])
                 pic2 = Pic(**pic_row) if pic_row is not None else None
 
-            # Verify the images in the selected image set actually exist on disk
-            # Blank out missing references and swap positions if necessary to try and get
-            # a valid image in the first slot.
-            if pic1 and not os.path.isfile(pic1.fname):
-                pic1 = None
-            if pic2 and not os.path.isfile(pic2.fname):
-                pic2 = None
+            # get_file_info returns None for images no longer on disk (it stats each file anyway to
+            # spot changes). Swap positions if necessary to try and get a valid image in the first slot.
             if (not pic1 and pic2):
                 pic1, pic2 = pic2, pic1
 
@@ -438,10 +458,7 @@ class Model:
         return self.__current_pics
 
     def get_number_of_files(self):
-        return sum(
-                    sum(1 for pic in pics if pic is not None)
-                    for pics in self.__file_list
-                )
+        return self.__number_of_images
 
     def get_current_pics(self):
         return self.__current_pics
@@ -452,18 +469,25 @@ class Model:
         if pic is None:
             return None
         f_to_delete = pic.fname
-        move_to_dir = os.path.expanduser(self.__deleted_pictures)
-        # TODO should these os system calls be inside a try block
-        # in case the file has been deleted after it started to show?
-        if not os.path.exists(move_to_dir):
-            os.system("mkdir {}".format(move_to_dir))  # problems with ownership using python func
-        os.system("mv '{}' '{}'".format(f_to_delete, move_to_dir))  # and with SMB drives
-        # find and delete record from __file_list
-        for i, file_rec in enumerate(self.__file_list):
-            if file_rec[0] == pic.file_id:  # database id TODO check that db tidies itself up
-                self.__file_list.pop(i)
-                self.__number_of_files -= 1
-                break
+        move_to_dir = self.__deleted_pictures
+        try:
+            os.makedirs(move_to_dir, exist_ok=True)
+            # rename if on the same drive, otherwise copy the contents only, as with mv, copying
+            # permissions and times fails on SMB drives. Full target name so an older copy is replaced
+            shutil.move(f_to_delete, os.path.join(move_to_dir, os.path.basename(f_to_delete)),
+                        copy_function=shutil.copyfile)
+        except OSError as e:  # i.e. the file was deleted after it started to show
+            self.__logger.warning("Can't move %s to %s: %s", f_to_delete, move_to_dir, e)
+        # find and delete record from __file_list. The current pic normally came from the slot just
+        # before __file_index so check that first rather than scanning the whole list
+        i = self.__file_index - 1
+        if not (0 <= i < self.__number_of_files and self.__file_list[i][0] == pic.file_id):
+            i = next((j for j, file_rec in enumerate(self.__file_list)
+                      if file_rec[0] == pic.file_id), None)  # database id TODO check that db tidies itself up
+        if i is not None:
+            file_rec = self.__file_list.pop(i)
+            self.__number_of_files -= 1
+            self.__number_of_images -= len(file_rec)
 
     def __get_files(self):
         if self.subdirectory != "":
@@ -497,6 +521,7 @@ class Model:
 
         self.__file_list = self.__image_cache.query_cache(where_clause, sort_clause)
         self.__number_of_files = len(self.__file_list)
+        self.__number_of_images = sum(len(file_ids) for file_ids in self.__file_list)
         self.__file_index = 0
         self.__num_run_through = 0
         self.__reload_files = False
@@ -0,0 +1,162 @@
+import os
+import shutil
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from picframe import image_cache
+from picframe.image_cache import FolderWatcher, ImageCache
+
+
+@pytest.fixture
+def cache_factory(tmp_path, monkeypatch):
+    """ImageCache whose own thread stays idle until stop(), so the test drives update_cache itself."""
+    loop = ImageCache._ImageCache__loop
+
+    def idle_loop(self):
+        while self._ImageCache__keep_looping:
+            time.sleep(0.01)
+        loop(self)  # only does the shutdown now
+
+    monkeypatch.setattr(ImageCache, "_ImageCache__loop", idle_loop)
+    caches = []
+
+    def make(pic_dir):
+        cache = ImageCache(str(pic_dir), False, str(tmp_path / "pictureframe.db3"), None, 0.1)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.stop()
+
+
+def rescan(cache):
+    watcher = cache._ImageCache__watcher
+    if watcher is not None:
+        watcher.dispatch(SimpleNamespace(event_type="modified"))
+    cache.update_cache()
+
+
+def add_picture(folder, name):
+    folder.mkdir(parents=True, exist_ok=True)
+    # folder mtimes are compared in whole seconds, step them on rather than wait
+    mod_tm = max(time.time(), folder.stat().st_mtime) + 10
+    shutil.copy("test/images/AlleExif.JPG", folder / name)
+    os.utime(folder, (mod_tm, mod_tm))
+
+
+def test_folder_watcher_ignores_reads():
+    watcher = FolderWatcher()
+    assert watcher.changed is True  # always scan once at start
+    watcher.changed = False
+    for event_type in ("opened", "closed", "closed_no_write"):
+        watcher.dispatch(SimpleNamespace(event_type=event_type))
+    assert watcher.changed is False
+    watcher.dispatch(SimpleNamespace(event_type="created"))
+    assert watcher.changed is True
+
+
+def test_watcher_triggers_rescan(tmp_path, monkeypatch, cache_factory):
+    # only a watcher event can start another walk of the folder tree during this test
+    monkeypatch.setattr(image_cache, "FULL_SCAN_INTERVALS", 100000)
+    get_folders = ImageCache._ImageCache__get_folders
+    walks = []
+
+    def counting_get_folders(self):
+        walks.append(self)
+        return get_folders(self)
+
+    monkeypatch.setattr(ImageCache, "_ImageCache__get_folders", counting_get_folders)
+    pic_dir = tmp_path / "pictures"
+    add_picture(pic_dir, "first.jpg")
+    cache = cache_factory(pic_dir)
+    watcher = FolderWatcher()
+    cache._ImageCache__watcher = watcher  # stands in for the watchdog observer
+    cache.update_cache()
+    cache.update_cache()
+    assert len(walks) == 1  # nothing changed since the first walk
+    assert len(cache.query_cache("1")) == 1
+
+    add_picture(pic_dir, "second.jpg")
+    cache.update_cache()
+    assert len(walks) == 1  # not noticed until the watcher reports it
+    watcher.dispatch(SimpleNamespace(event_type="created"))
+    cache.update_cache()
+    assert len(walks) == 2
+    assert len(cache.query_cache("1")) == 2
+
+
+def test_observer_runs_on_cache_thread(tmp_path):
+    pytest.importorskip("watchdog")
+    pic_dir = tmp_path / "pictures"
+    add_picture(pic_dir, "first.jpg")
+    cache = ImageCache(str(pic_dir), False, str(tmp_path / "pictureframe.db3"), None, 0.1)
+    cache.stop()
+    observer = cache._ImageCache__observer
+    assert observer is not None
+    assert not observer.is_alive()  # stopped and joined by stop()
+
+
+def test_unreadable_folder_is_not_purged(tmp_path, monkeypatch, cache_factory):
+    pic_dir = tmp_path / "pictures"
+    add_picture(pic_dir / "a", "one.jpg")
+    add_picture(pic_dir / "b" / "sub", "two.jpg")
+    cache = cache_factory(pic_dir)
+    rescan(cache)
+    assert len(cache.query_cache("1")) == 2
+
+    scandir = os.scandir
+    unreadable = str(pic_dir / "b")
+
+    def failing_scandir(path="."):
+        if str(path) == unreadable:
+            raise PermissionError(13, "Permission denied", unreadable)
+        return scandir(path)
+
+    monkeypatch.setattr(os, "scandir", failing_scandir)
+    cache.purge_files()
+    rescan(cache)
+    assert len(cache.query_cache("1")) == 2  # b couldn't be read so its sub folder wasn't walked, it's still there
+
+    monkeypatch.setattr(os, "scandir", scandir)
+    shutil.rmtree(pic_dir / "b")
+    cache.purge_files()
+    rescan(cache)
+    assert len(cache.query_cache("1")) == 1
+
+
+def test_hidden_folders_skipped_but_walked(tmp_path, cache_factory):
+    pic_dir = tmp_path / "pictures"
+    add_picture(pic_dir, "shown.jpg")
+    add_picture(pic_dir / ".hidden", "skipped.jpg")
+    add_picture(pic_dir / ".hidden" / "sub", "below_hidden.jpg")
+    add_picture(pic_dir / "a" / ".AppleDouble" / "sub", "junk.jpg")
+    cache = cache_factory(pic_dir)
+    rescan(cache)
+    files = sorted(os.path.basename(cache.get_file_info(file_id[0])["fname"]) for file_id in cache.query_cache("1"))
+    assert files == ["below_hidden.jpg", "shown.jpg"]
+
+
+def test_failed_geo_lookups_expire(tmp_path, monkeypatch, cache_factory):
+    clock = [1000.0]
+    monkeypatch.setattr(image_cache.time, "time", lambda: clock[0])
+    lookups = []
+
+    def get_address(lat, lon):
+        lookups.append((lat, lon))
+        return ""  # i.e. no network
+
+    cache = cache_factory(tmp_path / "pictures")
+    cache._ImageCache__geo_reverse = SimpleNamespace(get_address=get_address)
+    get_geo_location = cache._ImageCache__get_geo_location
+    assert get_geo_location(1.0, 2.0) is False
+    assert get_geo_location(1.0, 2.0) is False
+    assert len(lookups) == 1  # not retried before GEO_RETRY_DELAY
+
+    clock[0] += image_cache.GEO_RETRY_DELAY
+    assert get_geo_location(3.0, 4.0) is False
+    assert list(cache._ImageCache__geo_failed) == [(3.0, 4.0)]  # (1.0, 2.0) was due for a retry
+    assert get_geo_location(1.0, 2.0) is False
+    assert len(lookups) == 3
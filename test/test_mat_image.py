@@ -0,0 +1,70 @@
+import logging
+
+import numpy as np
+from PIL import Image
+
+from src.picframe import mat_image
+from src.picframe.mat_image import KmeansNp
+
+logger = logging.getLogger("test_mat_image")
+logger.setLevel(logging.DEBUG)
+
+
+def two_color_image():
+    array = np.zeros((100, 100, 3), dtype=np.uint8)
+    array[:, :50] = (200, 40, 40)  # saturated red
+    array[:, 50:] = (90, 90, 90)  # grey
+    return Image.fromarray(array)
+
+
+def gradient_image():
+    y, x = np.mgrid[0:240, 0:320]
+    array = np.stack([x * 255 // 319, y * 255 // 239, (x + y) * 255 // 558], axis=-1)
+    return Image.fromarray(array.astype(np.uint8))
+
+
+def test_kmeans_most_saturated_first(monkeypatch):
+    monkeypatch.setattr(mat_image, "rng", np.random.default_rng(0))  # numpy path when cv2 isn't installed
+    colors = KmeansNp(k=2, max_iterations=10, size=100).run(two_color_image())
+    assert colors.dtype == np.uint8
+    assert colors.shape == (2, 3)
+    assert tuple(colors[0].tolist()) == (200, 40, 40)
+    assert tuple(colors[1].tolist()) == (90, 90, 90)
+
+
+def test_kmeans_numpy_fallback(monkeypatch):
+    monkeypatch.setattr(mat_image, "cv2", None)
+    for seed in range(20):  # random starting centroids must not collapse onto one colour
+        monkeypatch.setattr(mat_image, "rng", np.random.default_rng(seed))
+        colors = KmeansNp(k=2, max_iterations=10, size=100).run(two_color_image())
+        assert colors.shape == (2, 3)
+        assert tuple(colors[0].tolist()) == (200, 40, 40)
+        assert tuple(colors[1].tolist()) == (90, 90, 90)
+
+
+def test_kmeans_fewer_colors_than_k(monkeypatch):
+    monkeypatch.setattr(mat_image, "cv2", None)
+    colors = KmeansNp(k=3, max_iterations=10, size=100).run(two_color_image())
+    assert colors.shape == (2, 3)
+
+
+def test_float_color_wrap_matches_reference():
+    # reference rendered with the ImageOps.expand version of this style, before the frame was drawn
+    # straight into the drop shadow. Allow a level of rounding drift between Pillow versions.
+    mat = mat_image.MatImage((400, 300), mat_type='float_color_wrap', outer_mat_color=(120, 80, 60),
+                             resource_folder='src/picframe/data/mat')
+    out = np.asarray(mat.mat_image((gradient_image(),)), dtype=np.int16)
+    expected = np.asarray(Image.open('test/images/float_color_wrap.png'), dtype=np.int16)
+    assert out.shape == expected.shape
+    assert np.abs(out - expected).max() <= 1
+
+
+def test_scale_image_close_to_bicubic():
+    # bilinear with reducing_gap replaced a plain bicubic resize, check it still looks the same
+    mat = mat_image.MatImage((400, 300), resource_folder='src/picframe/data/mat')
+    image = Image.open('test/images/AlleExif.JPG').convert('RGB')
+    out = np.asarray(mat._MatImage__scale_image(image, (400, 300)), dtype=np.float64)
+    expected = np.asarray(image.resize((out.shape[1], out.shape[0]), resample=Image.Resampling.BICUBIC),
+                          dtype=np.float64)
+    psnr = 10 * np.log10(255 ** 2 / np.mean((out - expected) ** 2))
+    assert psnr > 35